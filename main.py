@@ -1,16 +1,43 @@
 import asyncio
-from dbus_next.aio import MessageBus, ProxyObject, ProxyInterface
+from dbus_fast.aio import MessageBus, ProxyObject, ProxyInterface
+from dbus_fast.errors import DBusError, InterfaceNotFoundError
+from dbus_fast.introspection import Node
 import dataclasses
+import hashlib
 import websockets
-import json
+import orjson
 from aiohttp import web
 import pathlib
+import time
+from typing import Callable
+import uvloop
 
 HOST = "0.0.0.0"
 PORT_WS = 8765
 PORT_ART = 8766
 
-UPDATE_INTERVAL = 5
+UPDATE_DEBOUNCE = 0.05
+PLAYER_TIMEOUT = 2
+MAX_CLIENT_BUFFER = 256 * 1024
+
+PLACEHOLDER_ART = pathlib.Path("placeholder_art.png")
+
+
+def _mget(metadata: dict, key: str, default):
+    variant = metadata.get(key)
+    return variant.value if variant is not None else default
+
+
+def art_hash(artUrl: str) -> str:
+    # local files can be rewritten in place with a new cover, so their version is part of the hash
+    key = artUrl
+    if artUrl.startswith("file://"):
+        try:
+            st = pathlib.Path(artUrl[7:]).stat()
+            key = f"{artUrl}:{st.st_mtime_ns}:{st.st_size}"
+        except OSError:
+            pass
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
 
 
 class MprisMonitor:
@@ -19,8 +46,12 @@ class MprisMonitor:
         player_obj: ProxyObject
         iface_props: ProxyInterface
         iface_player: ProxyInterface
+        has_loop: bool
+        has_shuffle: bool
+        on_seeked: Callable[[int], None]
+        seeked_position: int | None = None
 
-    @dataclasses.dataclass
+    @dataclasses.dataclass(slots=True)
     class TrackInfo:
         title: str
         artist: list[str]
@@ -29,6 +60,7 @@ class MprisMonitor:
         trackid: str
         length: int
         position: int
+        position_wall_time: float
         status: str
         loop: str
         shuffle: bool
@@ -41,10 +73,22 @@ class MprisMonitor:
 
         self.players: dict[str, MprisMonitor.MprisPlayer] = {}
         self.current_track_infos: dict[str, MprisMonitor.TrackInfo] = {}
+        self._last_snapshot_json: bytes | None = None
+        self._bg_tasks: set[asyncio.Task] = set()
+        self._update_pending: asyncio.Task | None = None
+        self._update_lock = asyncio.Lock()
+        self._mpris_introspection: dict[str, Node] = {}
 
     def set_update_callback(self, callback):
         self._update_callback = callback
 
+    def _create_task(self, coro):
+        # keep a reference so signal-triggered tasks are not garbage collected mid-flight
+        task = asyncio.create_task(coro)
+        self._bg_tasks.add(task)
+        task.add_done_callback(self._bg_tasks.discard)
+        return task
+
     async def start(self):
         self._bus = await MessageBus().connect()
 
@@ -57,92 +101,225 @@ class MprisMonitor:
                 return
 
             if new_owner and not old_owner:
-                asyncio.create_task(self._add_player(name))
+                self._create_task(self._add_player(name))
             elif old_owner and not new_owner:
-                asyncio.create_task(self._remove_player(name))
+                self._create_task(self._remove_player(name))
 
         self._dbus.on_name_owner_changed(name_owner_changed)
 
         for player_name in await self._get_player_names():
             await self._add_player(player_name)
 
-    async def update_loop(self):
-        while True:
-            if any(track_info.status == "Playing" for track_info in self.current_track_infos.values()):
-                await self.update()
-            await asyncio.sleep(UPDATE_INTERVAL)
-
     async def _get_player_names(self):
         names = await self._dbus.call_list_names()
         player_names = [n for n in names if n.startswith("org.mpris.MediaPlayer2.")]
         return player_names
 
+    def _schedule_update(self):
+        # coalesce bursts of signals (e.g. Metadata + PlaybackStatus) into a single update
+        if self._update_pending is None:
+            self._update_pending = self._create_task(self._debounced_update(UPDATE_DEBOUNCE))
+
+    async def _debounced_update(self, delay: float):
+        await asyncio.sleep(delay)
+        self._update_pending = None
+        await self.update()
+
     def _iface_on_properties_changed(self, interface, changed, invalidated):
-        if "PlaybackStatus" in changed or "Metadata" in changed:
-            asyncio.create_task(self.update())
+        if changed.keys() & {"PlaybackStatus", "Metadata", "LoopStatus", "Shuffle", "Rate"}:
+            self._schedule_update()
 
-    async def _add_player(self, name: str):
-        if name in self.players:
-            return
+    def _iface_on_seeked(self, name: str, position: int):
+        player = self.players.get(name)
+        if player:
+            player.seeked_position = position
+            self._schedule_update()
 
-        introspection = await self._bus.introspect(name, "/org/mpris/MediaPlayer2")
+    def _get_player_interfaces(self, name: str, introspection: Node) -> tuple[ProxyObject, ProxyInterface, ProxyInterface]:
         player_obj = self._bus.get_proxy_object(name, "/org/mpris/MediaPlayer2", introspection)
         iface_props = player_obj.get_interface("org.freedesktop.DBus.Properties")
         iface_player = player_obj.get_interface("org.mpris.MediaPlayer2.Player")
+        return player_obj, iface_props, iface_player
 
-        iface_props.on_properties_changed(self._iface_on_properties_changed)
+    async def _add_player(self, name: str):
+        if name in self.players:
+            return
+
+        # instances of the same player (e.g. chromium.instance1234) usually expose identical interfaces
+        key = name.partition(".instance")[0]
+        introspection = self._mpris_introspection.get(key)
+        if introspection is not None:
+            player_obj, iface_props, iface_player = self._get_player_interfaces(name, introspection)
+            # a cached node can't vouch for optional properties it lacks, this instance may still have them
+            if not (hasattr(iface_player, "get_loop_status") and hasattr(iface_player, "get_shuffle")):
+                introspection = None
+        if introspection is None:
+            introspection = await self._bus.introspect(name, "/org/mpris/MediaPlayer2")
+            try:
+                player_obj, iface_props, iface_player = self._get_player_interfaces(name, introspection)
+            except InterfaceNotFoundError:
+                self._mpris_introspection.pop(key, None)
+                raise
+            self._mpris_introspection[key] = introspection
+
+        def on_seeked(position):
+            self._iface_on_seeked(name, position)
 
-        self.players[name] = MprisMonitor.MprisPlayer(player_obj=player_obj, iface_props=iface_props, iface_player=iface_player)
+        iface_props.on_properties_changed(self._iface_on_properties_changed)
+        iface_player.on_seeked(on_seeked)
+
+        self.players[name] = MprisMonitor.MprisPlayer(
+            player_obj=player_obj,
+            iface_props=iface_props,
+            iface_player=iface_player,
+            has_loop=hasattr(iface_player, "get_loop_status"),
+            has_shuffle=hasattr(iface_player, "get_shuffle"),
+            on_seeked=on_seeked,
+        )
         await self.update()
 
     async def _remove_player(self, name: str):
         if name in self.players:
             self.players[name].iface_props.off_properties_changed(self._iface_on_properties_changed)
+            self.players[name].iface_player.off_seeked(self.players[name].on_seeked)
             del self.players[name]
-            del self.current_track_infos[name]
             await self.update()
 
     def _art_url_wrapper(self, artUrl: str, player: str) -> str:
         if not artUrl or artUrl.startswith("file://"):
-            return f"http://localhost:{PORT_ART}/art/{player}"  # TODO: add random suffix to avoid caching
+            return f"http://localhost:{PORT_ART}/art/{player}/{art_hash(artUrl)}"
         return artUrl
 
-    async def _try(self, func, alt):
-        try:
-            return await func()
-        except Exception:
-            return alt
+    def _position_sample(self, name: str, position: int, status: str) -> tuple[int, float]:
+        # keep the previous sample if the new position matches its extrapolation, so unchanged players serialize identically
+        now = time.time()
+        prev = self.current_track_infos.get(name)
+        if prev and prev.status == status:
+            expected = prev.position + (now - prev.position_wall_time if status == "Playing" else 0)
+            if abs(expected - position) < 1:
+                return prev.position, prev.position_wall_time
+        return position, now
+
+    @staticmethod
+    def _same_track(a: "MprisMonitor.TrackInfo", b: "MprisMonitor.TrackInfo") -> bool:
+        # many players omit mpris:trackid or reuse it, so compare all metadata
+        return (
+            a.title == b.title
+            and a.artist == b.artist
+            and a.album == b.album
+            and a.artUrl == b.artUrl
+            and a.trackid == b.trackid
+            and a.length == b.length
+            and a.status == b.status
+        )
 
     async def update(self):
-        @dataclasses.dataclass
-        class MF:
-            value: any
+        # updates replace current_track_infos wholesale, so they must not interleave
+        async with self._update_lock:
+            await self._update()
 
-        for name, player in self.players.items():
+    async def _update(self):
+        async def _collect(name: str, player: MprisMonitor.MprisPlayer) -> MprisMonitor.TrackInfo:
             iface_player = player.iface_player
-            metadata = await iface_player.get_metadata()
-
-            self.current_track_infos[name] = MprisMonitor.TrackInfo(
-                title=metadata.get("xesam:title", MF("Unknown Title")).value,
-                artist=metadata.get("xesam:artist", MF(["Unknown Artist"])).value,
-                album=metadata.get("xesam:album", MF("Unknown Album")).value,
-                artUrl=self._art_url_wrapper(metadata.get("mpris:artUrl", MF("")).value, name),
-                trackid=metadata.get("mpris:trackid", MF("")).value,
-                length=int(metadata.get("mpris:length", MF(0)).value / 1_000_000),
-                position=int(await self._try(iface_player.get_position, 0) / 1_000_000),
-                status=await self._try(iface_player.get_playback_status, "Unknown"),
-                loop=(await iface_player.get_loop_status()) if "get_loop_status" in iface_player.__dict__ else "None",
-                shuffle=(await iface_player.get_shuffle()) if "get_shuffle" in iface_player.__dict__ else False,
+            calls = [
+                iface_player.get_metadata(),
+                iface_player.get_playback_status(),
+            ]
+            if player.has_loop:
+                calls.append(iface_player.get_loop_status())
+            if player.has_shuffle:
+                calls.append(iface_player.get_shuffle())
+
+            metadata, status, *optional = await asyncio.gather(*calls, return_exceptions=True)
+            if isinstance(metadata, Exception):
+                raise metadata
+            if isinstance(status, Exception):
+                status = "Unknown"
+            loop = optional.pop(0) if player.has_loop else "None"
+            shuffle = optional.pop(0) if player.has_shuffle else False
+
+            # the introspection may be cached from another instance, which doesn't guarantee these optional properties
+            if isinstance(loop, Exception):
+                player.has_loop = not isinstance(loop, DBusError)
+                loop = "None"
+            if isinstance(shuffle, Exception):
+                player.has_shuffle = not isinstance(shuffle, DBusError)
+                shuffle = False
+
+            info = MprisMonitor.TrackInfo(
+                title=_mget(metadata, "xesam:title", "Unknown Title"),
+                artist=_mget(metadata, "xesam:artist", ["Unknown Artist"]),
+                album=_mget(metadata, "xesam:album", "Unknown Album"),
+                artUrl=self._art_url_wrapper(_mget(metadata, "mpris:artUrl", ""), name),
+                trackid=_mget(metadata, "mpris:trackid", ""),
+                length=int(_mget(metadata, "mpris:length", 0) / 1_000_000),
+                position=0,
+                position_wall_time=0.0,
+                status=status,
+                loop=loop,
+                shuffle=shuffle,
             )
 
+            # position is only sampled when it can't be extrapolated from the previous sample
+            prev = self.current_track_infos.get(name)
+            same_track = prev is not None and self._same_track(prev, info)
+            seeked, player.seeked_position = player.seeked_position, None
+            if seeked is not None:
+                position = int(seeked / 1_000_000)
+            elif same_track:
+                info.position, info.position_wall_time = prev.position, prev.position_wall_time
+                return info
+            else:
+                try:
+                    position = int(await iface_player.get_position() / 1_000_000)
+                except Exception:
+                    position = 0
+
+            if same_track:
+                info.position, info.position_wall_time = self._position_sample(name, position, status)
+            else:
+                info.position, info.position_wall_time = position, time.time()
+            return info
+
+        names = list(self.players)
+        # bounded so a hung player can't hold the update lock, it just keeps its previous state
+        results = await asyncio.gather(
+            *(asyncio.wait_for(_collect(name, self.players[name]), PLAYER_TIMEOUT) for name in names),
+            return_exceptions=True,
+        )
+
+        track_infos = {}
+        changed = False
+        for name, result in zip(names, results):
+            if name not in self.players:
+                continue
+            prev = self.current_track_infos.get(name)
+            if isinstance(result, Exception):
+                print(f"Failed to update player {name}, keeping previous state: {result!r}")
+            if isinstance(result, Exception) or result == prev:
+                if prev:
+                    track_infos[name] = prev
+                continue
+            track_infos[name] = result
+            changed = True
+        changed = changed or track_infos.keys() != self.current_track_infos.keys()
+        self.current_track_infos = track_infos
+
+        if not changed and self._last_snapshot_json is not None:
+            return
+
+        payload = orjson.dumps(self.current_track_infos)
+        self._last_snapshot_json = payload
+
         if self._update_callback:
-            await self._update_callback(self.current_track_infos)
+            await self._update_callback(self.current_track_infos, payload)
 
 
 class MprisWebSocket:
     def __init__(self):
         self._server = None
         self._clients = set()
+        self._drop_tasks = {}
 
         self._connect_callback = None
         self._message_callback = None
@@ -154,10 +331,22 @@ class MprisWebSocket:
         self._message_callback = callback
 
     async def start(self):
-        self._server = await websockets.serve(self._handle_client, HOST, PORT_WS)
-
-    async def send_all(self, message: str):
-        await asyncio.gather(*(client.send(message) for client in self._clients))
+        # payloads are small and broadcast identically to every client, per-connection deflate only costs cpu
+        self._server = await websockets.serve(self._handle_client, HOST, PORT_WS, compression=None)
+
+    async def send_all(self, message: bytes):
+        clients = []
+        for client in tuple(self._clients):
+            if client in self._drop_tasks:
+                continue
+            if client.state is websockets.State.OPEN and client.transport.get_write_buffer_size() > MAX_CLIENT_BUFFER:
+                # stalled client, drop it instead of buffering broadcasts for it forever
+                task = asyncio.create_task(client.close(1008, "client too slow"))
+                self._drop_tasks[client] = task
+                task.add_done_callback(lambda _, client=client: self._drop_tasks.pop(client, None))
+                continue
+            clients.append(client)
+        websockets.broadcast(clients, message, text=True)
 
     async def _handle_client(self, client):
         self._clients.add(client)
@@ -169,11 +358,13 @@ class MprisWebSocket:
                 await self._handle_message(client, message)
 
             await client.wait_closed()
+        except websockets.ConnectionClosed:
+            pass
         finally:
             self._clients.remove(client)
 
     async def _handle_message(self, client, message):
-        data = json.loads(message)
+        data = orjson.loads(message)
         if self._message_callback:
             await self._message_callback(client, data)
 
@@ -181,7 +372,7 @@ class MprisWebSocket:
 class ArtServer:
     def __init__(self):
         app = web.Application()
-        app.router.add_get("/art/{player}", self._handle_art)
+        app.router.add_get("/art/{player}/{hash}", self._handle_art)
         self._runner = web.AppRunner(app)
 
         self._request_callback = None
@@ -197,9 +388,12 @@ class ArtServer:
     async def _handle_art(self, request):
         player = request.match_info["player"]
         if self._request_callback:
-            path = await self._request_callback(player)
+            path, immutable = await self._request_callback(player, request.match_info["hash"])
             if path:
-                return web.FileResponse(path=path, headers={"Content-Type": "image/jpeg"})
+                # only urls keyed on the exact file version are immutable, anything else is revalidated via ETag
+                cache_control = "public, max-age=31536000, immutable" if immutable else "no-cache"
+                # FileResponse handles content type, ETag/304 and sendfile
+                return web.FileResponse(path=path, headers={"Cache-Control": cache_control})
         return web.Response(status=404)  # TODO: return a placeholder image
 
 
@@ -211,8 +405,9 @@ async def main():
     async def on_client_connect(client):
         print(f"WS client connected: {client.remote_address}")
 
-        await monitor.update()
-        await client.send(json.dumps({name: dataclasses.asdict(info) for name, info in monitor.current_track_infos.items()}))
+        if monitor._last_snapshot_json is None:
+            await monitor.update()
+        await client.send(monitor._last_snapshot_json, text=True)
 
     async def on_message(client, data):
         print(f"WS message from {client.remote_address}: {data}")
@@ -243,24 +438,31 @@ async def main():
                     offset = data.get("value", 0) * 1_000_000
                     await iface_player.call_seek(offset)
 
-    async def on_art_request(player):
+    async def on_art_request(player, requested_hash):
         print(f"Art request for player: {player}")
 
         mpris_player = monitor.players.get(player)
         if mpris_player:
-            artUrl = (await mpris_player.iface_player.get_metadata()).get("mpris:artUrl").value
+            metadata = await mpris_player.iface_player.get_metadata()
+            artUrl = _mget(metadata, "mpris:artUrl", "")
+            current_hash = art_hash(artUrl)
+            # the announced url may predate the file being written or rewritten
+            track_info = monitor.current_track_infos.get(player)
+            announced = track_info is not None and track_info.artUrl.endswith(f"/{requested_hash}")
+            if requested_hash != current_hash and not announced:
+                return None, False
             if artUrl.startswith("file://"):
                 path = pathlib.Path(artUrl[7:])
                 if path.exists():
-                    return path
-        return pathlib.Path("placeholder_art.png")
+                    return path, requested_hash == current_hash
+        return PLACEHOLDER_ART, False
 
-    async def on_track_update(track_infos):
+    async def on_track_update(track_infos, payload):
         print(f"MPRIS update ({len(track_infos)} players):")
         for name, info in track_infos.items():
             print(f" - {name}: {info.title} ({info.album}) by {', '.join(info.artist)} [{info.status}: {info.position}/{info.length}s] {info.artUrl}")
 
-        await websocket.send_all(json.dumps({name: dataclasses.asdict(info) for name, info in track_infos.items()}))
+        await websocket.send_all(payload)
 
     websocket.set_message_callback(on_message)
     websocket.set_connect_callback(on_client_connect)
@@ -271,9 +473,8 @@ async def main():
     await art_server.start()
     await monitor.start()
 
-    await monitor.update_loop()
     await websocket._server.wait_closed()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    uvloop.run(main())